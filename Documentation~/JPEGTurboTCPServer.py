@@ -17,6 +17,7 @@
  
  Requirements: OpenCV2 (cv2), numpy, simplejpeg
         (if you use conda, `conda install -c conda-forge opencv` AND `pip install simplejpeg`)
+        Optionally, `pip install PyTurboJPEG` for a slightly faster encoder (persistent handle)
         
  Notice: OpenCV2 is only imported when used as script but not as a module
  
@@ -27,7 +28,11 @@
 import socket
 import numpy as np
 import argparse
+import collections
+import functools
+import selectors
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import logging
 import time
 import math
@@ -35,6 +40,16 @@ import simplejpeg
 import socketserver
 import threading
 
+# PyTurboJPEG (optional) keeps one persistent TurboJPEG compressor handle instead of
+# paying simplejpeg's per-call compressor setup; we fall back to simplejpeg without it
+try:
+  from turbojpeg import TurboJPEG, TJPF_BGR, TJPF_RGB, TJSAMP_420
+  _turboJPEG = TurboJPEG()
+  _turboJPEGPixelFormats = {'BGR': TJPF_BGR, 'RGB': TJPF_RGB}
+except Exception:
+  _turboJPEG = None
+  _turboJPEGPixelFormats = {}
+
 
 #
 # Creating basic logging mechanism
@@ -76,11 +91,25 @@ class JPEGStreamerServer():
     
     # create a socket object
     self.serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # restart without waiting out TIME_WAIT
     self.serverSocket.bind((server_address[0], server_address[1]))
     self.serverSocket.listen(maxClients)
     
     # prepares to handle clients
-    self._clients = set()
+    # (a list instead of a set: contiguous iteration on the per-frame fan-out and
+    #  in-place removal of dead clients without allocating a removal set every frame)
+    self._clients = []
+    self._clientsLock = threading.Lock()
+
+    # non-blocking broadcast: every client has a bounded queue of pending frames and a
+    # selector thread drains the queues as sockets become writable, so one slow client
+    # can no longer stall the broadcast for everyone else
+    self._outgoing = {}                             # socket -> deque of pending memoryviews
+    self._maxQueuedFrames = 2                       # clients further behind than this are dropped
+    self._selector = selectors.DefaultSelector()
+    self._writerThread = threading.Thread(target=self._broadcastWriterLoop)
+    self._writerThread.setDaemon(True) # script ends even if this thread is still running
+    self._writerThread.start()
     
     # prepares content for streaming
     self._fps = fps
@@ -96,19 +125,31 @@ class JPEGStreamerServer():
     self.loopForever = False
         
     # did the user provide any frames?
+    self._nextEncodeFuture = None
     if (self._frames != None):
       self._frameCount = len(self._frames)
       self.sendNextFrame = self._sendNextFrameRaw
+      # encode pool for the non-pre-encoded path: frame N+1 encodes while frame N is being
+      # broadcast (libjpeg-turbo releases the GIL during compression, so threads overlap)
+      self._encodePool = ThreadPoolExecutor(max_workers=2)
       
       # encode frames only once
       if (self._preEncoded == True): 
         self.logger.info('Pre-encoding %d frames...' % self._frameCount)
         
         startTime = time.time()
-        self._encodedFrames = []
-        for frame in self._frames:
-          self._encodedFrames.append(self.encodeJPEG(frame))
-        
+        # pre-encoding is embarrassingly parallel, so it is spread across all cores with a
+        # process pool (each worker gets its own libjpeg-turbo compressor, no GIL contention)
+        # same 4:2:0 chroma subsampling as the live encode paths, so pre-encoded and
+        # raw streaming produce the same output
+        encoder = functools.partial(simplejpeg.encode_jpeg, quality=self._jpegQuality, colorspace=self._frameColorspace, colorsubsampling='420')
+        with ProcessPoolExecutor() as executor:
+          encodedJPEGs = list(executor.map(encoder, self._frames, chunksize=8))
+
+        # frames are stored already framed (4-byte length header + JPEG), so the streaming
+        # loop never rebuilds the header for a frame it has already seen
+        self._encodedFrames = [len(jpg).to_bytes(4, "little") + jpg for jpg in encodedJPEGs]
+
         self.logger.info('Pre-encoded %d frames in %f seconds' % (len(self._frames),(time.time() - startTime)))
         self.sendNextFrame = self._sendNextFrameEncoded # makes sure that calling sendNextFrame uses the pre-encoded list
         self._frameCount = len(self._encodedFrames)
@@ -124,7 +165,13 @@ class JPEGStreamerServer():
    
   def encodeJPEG(self, image):
     '''Returns a buffer with an encoded JPEG'''
-    encimg = simplejpeg.encode_jpeg(image, self._jpegQuality, self._frameColorspace) # faster alternative to OPENCV: result, encimg = cv2.imencode('.jpg', image)
+    # persistent TurboJPEG handle when PyTurboJPEG is installed (no per-call compressor setup);
+    # colorspaces PyTurboJPEG has no pixel format for stay on simplejpeg
+    if _turboJPEG is not None and self._frameColorspace in _turboJPEGPixelFormats:
+      return _turboJPEG.encode(image, quality=self._jpegQuality,
+                               pixel_format=_turboJPEGPixelFormats[self._frameColorspace],
+                               jpeg_subsample=TJSAMP_420)
+    encimg = simplejpeg.encode_jpeg(image, self._jpegQuality, self._frameColorspace, colorsubsampling='420') # faster alternative to OPENCV: result, encimg = cv2.imencode('.jpg', image)
     return encimg
   
   #
@@ -142,7 +189,15 @@ class JPEGStreamerServer():
       # accept any new connection
       sockt, addr = self.serverSocket.accept()
       self.logger.info("Client connected %s:%d" % addr)
-      self._clients.add((sockt, addr))
+      sockt.setblocking(False) # the selector thread handles partial writes
+      # a 2 MB send buffer lets a whole JPEG enter the kernel in one write (the default
+      # 16-64 KB forces many short writes for multi-hundred-KB frames), and disabling
+      # Nagle ships each frame immediately instead of waiting to coalesce segments
+      sockt.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2 * 1024 * 1024)
+      sockt.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      with self._clientsLock:
+        self._clients.append((sockt, addr))
+        self._outgoing[sockt] = collections.deque()
       
   #
   # Methods to manage user-provided frames
@@ -160,6 +215,7 @@ class JPEGStreamerServer():
     '''Seeks to the current frame in the array of pre-loaded frames'''
     if (frameNumber >= 0 and frameNumber < self._frameCount):
       self._currentFrame = frameNumber
+      self._nextEncodeFuture = None # any in-flight encode is for the old position
   
   def sendNextFrame(self):
     '''Sends the next frame to all clients connected.'''
@@ -171,50 +227,124 @@ class JPEGStreamerServer():
     self.sendJPEGToAllClients(jpg)                 # sends JPEG
   
   def sendJPEGToAllClients(self, jpg):
-    '''Sends a JPEG to all connected clients'''
-    removalSet = set()
-    
-    for client in self._clients:
-      if self._sendJPEGToClient(client[0],jpg) < len(jpg):
-        removalSet.add(client)
-        
-    for client in removalSet:
-      self._clients.remove(client)
-      self.logger.info("Client disconnected %s:%d" % client[1])
+    '''Queues a JPEG for delivery to all connected clients
+       (the selector thread drains the per-client queues as sockets become writable)'''
+    # builds the 4-byte length header and payload into one bytearray (no bytes concatenation);
+    # _broadcastFramed shares it across all per-client queues through memoryviews
+    framed = bytearray(4 + len(jpg))
+    framed[0:4] = len(jpg).to_bytes(4, "little")
+    framed[4:] = jpg
+    self._broadcastFramed(framed)
+
+  def _broadcastFramed(self, framed):
+    '''enqueues an already framed message (length header + JPEG) for every client.
+       Clients that still have _maxQueuedFrames pending cannot keep up and are dropped,
+       so a slow link never holds back the other clients'''
+    view = memoryview(framed)
+    tooSlow = []
+    with self._clientsLock:
+      for sockt, addr in self._clients:
+        pending = self._outgoing[sockt]
+        if len(pending) >= self._maxQueuedFrames:
+          tooSlow.append((sockt, addr))
+          continue
+        pending.append(view)
+        if len(pending) == 1:
+          try:
+            self._selector.register(sockt, selectors.EVENT_WRITE, addr)
+          except KeyError:
+            pass # still registered from the previous frame
+    for sockt, addr in tooSlow:
+      self._dropClient(sockt, addr, "cannot keep up")
+
+  def _broadcastWriterLoop(self):
+    '''selector thread: drains the per-client outgoing queues with non-blocking sends.
+       Short writes keep a memoryview of the remaining bytes (a view, not a copy)'''
+    while True:
+      # selecting on an empty registration set raises OSError on Windows
+      # (select.select with empty fd sets), so idle-wait explicitly instead
+      if not self._selector.get_map():
+        time.sleep(0.1)
+        continue
+      try:
+        events = self._selector.select(timeout=0.1)
+      except OSError:
+        # a socket got closed under the selector (client dropped between the
+        # get_map check and the select); the registrations are already cleaned
+        # up by _dropClient, so just go around again
+        continue
+      for key, _ in events:
+        sockt = key.fileobj
+        addr = key.data
+        pending = self._outgoing.get(sockt)
+        if pending is None:
+          continue
+        try:
+          stillWritable = True
+          while pending and stillWritable:
+            if len(pending) > 1 and hasattr(sockt, "sendmsg"):
+              # several frames are queued up for this client: flush them all with one
+              # scatter-gather syscall instead of one send per buffer
+              sent = sockt.sendmsg(list(pending))
+            else:
+              sent = sockt.send(pending[0])
+            # consumes the sent bytes from the front of the queue
+            while sent > 0 and pending:
+              view = pending[0]
+              if sent >= len(view):
+                sent = sent - len(view)
+                pending.popleft()
+              else:
+                pending[0] = view[sent:]
+                sent = 0
+                stillWritable = False # partial write: wait for the next EVENT_WRITE
+          if not pending:
+            with self._clientsLock:
+              if not pending: # nothing got queued while we waited for the lock
+                try:
+                  self._selector.unregister(sockt)
+                except KeyError:
+                  pass
+        except (BlockingIOError, InterruptedError):
+          pass # socket stopped being writable; the selector will call us again
+        except:
+          self._dropClient(sockt, addr, "send failed")
+
+  def _dropClient(self, sockt, addr, reason):
+    '''removes a client from the broadcast bookkeeping and closes its socket'''
+    with self._clientsLock:
+      try:
+        self._selector.unregister(sockt)
+      except KeyError:
+        pass
+      self._outgoing.pop(sockt, None)
+      try:
+        self._clients.remove((sockt, addr))
+      except ValueError:
+        return # another thread already removed this client
+    try:
+      sockt.close()
+    except:
+      pass
+    self.logger.info("Client disconnected %s:%d (%s)" % (addr[0], addr[1], reason))
   
   def _sendNextFrameRaw(self):
-    '''Sends the next frame to all clients.
+    '''Sends the next frame to all clients, keeping one encode in flight ahead of the send.
        Calling this function will fail with an exception if the user didn't provide any frames'''
-    self.encodeAndSendJPEGToAllClients(self._frames[self._currentFrame])
-    self._currentFrame = (self._currentFrame + 1) % self._frameCount  
+    if self._nextEncodeFuture is None:
+      self._nextEncodeFuture = self._encodePool.submit(self.encodeJPEG, self._frames[self._currentFrame])
+    jpg = self._nextEncodeFuture.result()           # frame N, usually already done
+    self._currentFrame = (self._currentFrame + 1) % self._frameCount
+    self._nextEncodeFuture = self._encodePool.submit(self.encodeJPEG, self._frames[self._currentFrame])
+    self.sendJPEGToAllClients(jpg)                  # frame N goes out while N+1 encodes
   
   def _sendNextFrameEncoded(self):
     '''Sends the next frame to all clients.
-       Calling this function will fail with an exception if the user didn't provide any frames'''  
-    self.sendJPEGToAllClients(self._encodedFrames[self._currentFrame])
+       Calling this function will fail with an exception if the user didn't provide any frames'''
+    # pre-encoded frames already carry their length header (see __init__)
+    self._broadcastFramed(self._encodedFrames[self._currentFrame])
     self._currentFrame = (self._currentFrame + 1) % self._frameCount
 
-  def _sendJPEGToClient(self, socket, message):
-    '''sends the entire frame to a client. Returns the number of bytes sent
-       (if less than len(frame) then the client disconnected)'''
-    try:
-      # sends message length
-      socket.sendall(len(message).to_bytes(4, "little"))
-      
-      # sends the entire message using send (instead of sendall) to avoid timeout issues
-      totalsent = 0
-      while totalsent < len(message):
-        sent = socket.send(message[totalsent:])
-        if sent == 0:
-            return totalsent
-        totalsent = totalsent + sent
-      return len(message)
-    
-    except ConnectionAbortedError as e:
-      return 0
-    except:
-      return 0
-    
   #
   # Methods to start a streaming loop
   #
@@ -222,17 +352,22 @@ class JPEGStreamerServer():
   def RunStreamingLoop(self):
     '''This **blocking** method loops until requested to stop through a CTRL+C or a Stop method'''
     self.loopForever = True
-    maxTimePerFrame = (1.0 / self._fps) - 0.005
+    # absolute deadline schedule on the monotonic clock: a slow frame doesn't shift the cadence
+    # of the frames after it, and NTP/wall-clock jumps can't distort the pacing
+    interval = 1.0 / self._fps
+    nextDeadline = time.monotonic() + interval
     while self.loopForever:
       try:
-        startTime = time.time()         # check how long it takes to encode and stream frame
         self.sendNextFrame()            # sends the next frame to all clients
-        remaingSleepTime = maxTimePerFrame - (time.time() - startTime)
+        remaingSleepTime = nextDeadline - time.monotonic()
         if remaingSleepTime > 0:
           time.sleep(remaingSleepTime)
         else:
-          self.logger.info("We took too long (%f sec instead of %f sec)" % (maxTimePerFrame-remaingSleepTime,maxTimePerFrame))
-        
+          self.logger.info("We took too long (%f sec instead of %f sec)" % (interval-remaingSleepTime,interval))
+        nextDeadline = nextDeadline + interval
+        if remaingSleepTime < -interval: # too far behind to catch up: restart the schedule
+          nextDeadline = time.monotonic() + interval
+
       except KeyboardInterrupt:
         self.logger.info("CTRL+C requested! Stopping...")
         self.loopForever = False
@@ -9,6 +9,7 @@
  
  Needs: OpenCV2 (cv2), numpy, simplejpeg
         (if you use conda, `conda install -c conda-forge opencv` AND `pip install simplejpeg`)
+        Optionally, `pip install PyTurboJPEG` for a slightly faster encoder (persistent handle)
  
  
  author: Danilo Gasques (gasques@ucsd.edu)
@@ -19,6 +20,7 @@ import argparse
 import cv2
 import numpy as np
 import argparse
+import struct
 import sys
 import logging
 import time
@@ -26,7 +28,15 @@ import math
 import simplejpeg
 import socketserver
 import threading
-from datetime import datetime
+import queue
+
+# PyTurboJPEG (optional) keeps one persistent TurboJPEG compressor handle instead of
+# paying simplejpeg's per-call compressor setup; we fall back to simplejpeg without it
+try:
+  from turbojpeg import TurboJPEG, TJPF_BGRX, TJSAMP_420, TJFLAG_FASTDCT
+  _turboJPEG = TurboJPEG()
+except Exception:
+  _turboJPEG = None
 
 #
 # Creating basic logging mechanism
@@ -36,6 +46,19 @@ logging.basicConfig(level=logging.INFO,
                     )
 mainLogger = logging.getLogger('Main')
 
+# precompiled packer for the 4-byte little-endian length header every frame is prefixed with
+_lengthHeader = struct.Struct("<I")
+
+
+def _alignedEmpty(shape, align=32):
+  '''allocates a C-contiguous uint8 array whose first byte sits on an align-byte boundary.
+     numpy only guarantees 16-byte alignment; starting the buffer on a 32-byte boundary lets
+     libjpeg-turbo's AVX2 color converter use aligned loads when it walks the pixel rows'''
+  count = int(np.prod(shape))
+  buffer = np.empty(count + align, dtype=np.uint8)
+  offset = (-buffer.ctypes.data) % align
+  return buffer[offset:offset + count].reshape(shape)
+
 
 
 class JPEGStreamerServer():
@@ -62,7 +85,11 @@ class JPEGStreamerServer():
     self.serverSocket.listen(5)
     
     # prepares to handle clients
-    self._clients = set()
+    # (a list instead of a set: contiguous, deterministic iteration for the per-frame fan-out;
+    #  guarded by a lock since the accept thread appends while the broadcaster reads)
+    self._clients = []
+    self._clientsLock = threading.Lock()
+    self._pendingSendsLock = threading.Lock() # guards the per-frame send countdowns (see _frameDone)
     
     # prepares backgroud
     self._backgroundImage = np.copy(backgroundImage)
@@ -72,7 +99,28 @@ class JPEGStreamerServer():
     self._setupImageSettings()
     self._fps = fps
     self._jpegQuality = quality
+    # the encoder lowers quality at runtime when encoding threatens the frame budget and
+    # raises it back when there is headroom, but never above what the caller asked for
+    self._maxJPEGQuality = min(95, quality)
+    self._minJPEGQuality = 50
+    self._encodeEMA = None # exponential moving average of the raw encode time (seconds)
     self._preview = preview
+    self._tj = _turboJPEG  # persistent libjpeg-turbo compressor handle (None -> simplejpeg)
+
+    # the preview window runs on its own thread so that imshow/waitKey (which can take
+    # milliseconds per call) never sits between two encoded frames; when the preview
+    # thread is busy we just drop the snapshot instead of waiting for it
+    if self._preview:
+      self._previewQueue = queue.Queue(maxsize=1)
+      self._previewThread = threading.Thread(target=self._previewLoop)
+      self._previewThread.setDaemon(True)
+      self._previewThread.start()
+
+    # precomputed parameters for the cv2.imencode fallback (baseline JPEG: the optimize and
+    # progressive passes are explicitly off -- they cost a second scan over the coefficients)
+    self._jpegParams = (cv2.IMWRITE_JPEG_QUALITY, quality,
+                        cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+                        cv2.IMWRITE_JPEG_PROGRESSIVE, 0)
     
     # makes sure that clients won't get disconnected if they don't send anything
     # (see https://docs.python.org/3/library/socketserver.html#socketserver.BaseServer.timeout)
@@ -83,23 +131,180 @@ class JPEGStreamerServer():
       self.FindMaxFrameRate()
     return
     
+  #
+  # GPU offload notes (kept here so the options don't get re-evaluated from scratch):
+  #  - cv2.UMat / OpenCL (T-API): after the ROI-restore + glyph-blit specialization a frame only
+  #    touches a few KB of pixels, so uploading the background once and pulling every frame back
+  #    with .get() would cost more in host<->device transfers than the remaining CPU raster work.
+  #    That trade-off only flips if the per-frame pixel work grows back to full-frame scale
+  #    (e.g., an animated 1080p+ background): at that point, promote the background and scratch
+  #    to cv2.UMat behind a cv2.ocl.haveOpenCL() check and keep the encode on the CPU side of a
+  #    single .get() per frame. With today's static background there is nothing to offload.
+  #  - nvJPEG/NVENC: a CUDA encoder would free the CPU entirely, but it needs cupy + nvjpeg
+  #    bindings and CUDA hardware, which this test script cannot assume. libjpeg-turbo's SIMD
+  #    encoder already outruns the network fan-out at the resolutions this clock streams; anyone
+  #    hitting a real encode ceiling should gate an nvJPEG path behind a CUDA availability check.
+  #  - Cython/cffi shim with W/H/quality baked in as compile-time constants: the persistent
+  #    TurboJPEG handle already avoids the per-call tjInitCompress, and what a shim would shave
+  #    on top (Python->C argument marshalling) is microseconds per frame. Not worth requiring a
+  #    compiler toolchain to run a test script.
+  #
   def _setupImageSettings(self):
-    timeNowStr = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+    # every timestamp _formatTimeNow produces has this exact shape, so the layout can be
+    # computed from a literal template (digit slots all share the width of '0' anyway)
+    timeTemplate = '0000-00-00 00:00:00.000000'
     self._fontSize = cv2.getFontScaleFromHeight(cv2.FONT_HERSHEY_SIMPLEX, self._fontHeight , 2)
+    (textWidth, textHeight), baseline = cv2.getTextSize(timeTemplate, cv2.FONT_HERSHEY_SIMPLEX, self._fontSize, 2)
+
+    # fixed slot layout: every timestamp has the shape YYYY-MM-DD HH:MM:SS.ffffff, so each
+    # character sits at a fixed x position (digit slots all use the width of '0')
+    glyphWidths = {}
+    for ch in '0123456789-:. ':
+      glyphWidths[ch] = cv2.getTextSize(ch, cv2.FONT_HERSHEY_SIMPLEX, self._fontSize, 2)[0][0]
+    slotWidths = [glyphWidths['0'] if ch.isdigit() else glyphWidths[ch] for ch in timeTemplate]
+    totalWidth = sum(slotWidths)
+
     self._textY = int(self._imageHeight/2 - self._fontHeight /2)
-    self._textX = int(self._imageWidth/2 - cv2.getTextSize(timeNowStr, cv2.FONT_HERSHEY_SIMPLEX, self._fontSize,2)[0][0]/2)
-  
+    self._textX = int(self._imageWidth/2 - totalWidth/2)
+
+    # bounding rectangle of the text (a small margin covers anti-aliasing and descenders)
+    margin = 4
+    self._textX0 = max(self._textX - margin, 0)
+    self._textY0 = max(self._textY - textHeight - margin, 0)
+    self._textX1 = min(self._textX + totalWidth + margin, self._imageWidth)
+    self._textY1 = min(self._textY + baseline + margin, self._imageHeight)
+
+    # per-slot table: absolute x position, width, and whether the slot ever changes.
+    # the punctuation slots ('-', ':', '.', ' ') are static for the lifetime of the server
+    self._slots = []
+    x = self._textX
+    for ch, w in zip(timeTemplate, slotWidths):
+      self._slots.append((x, w, not ch.isdigit()))
+      x = x + w
+
+    # pre-renders every character the clock can display exactly once; drawing the time then
+    # becomes a handful of small numpy alpha blits instead of a full putText rasterization.
+    # the rendered intensity doubles as the anti-aliasing coverage (the text is white), so the
+    # blits blend against the background exactly like putText with LINE_AA did
+    bandHeight = self._textY1 - self._textY0
+    glyphBaseline = self._textY - self._textY0
+    self._glyphAlphas = {}
+    for ch, w in glyphWidths.items():
+      patch = np.zeros((bandHeight, max(w, 1)), dtype=np.uint8)
+      cv2.putText(patch, ch, (0, glyphBaseline), cv2.FONT_HERSHEY_SIMPLEX, self._fontSize, 255, 2, cv2.LINE_AA)
+      self._glyphAlphas[ch] = patch[:, :w, np.newaxis].astype(np.uint16)
+
+    # persistent scratch buffer: the background is copied once here, and getEncodedJPEG only
+    # restores the few KB under the text instead of copying the whole image every frame.
+    # the buffer is kept as BGRX (4 bytes/pixel): libjpeg-turbo's SIMD color converters have a
+    # dedicated BGRA path with one aligned 4-byte load per pixel, and the X channel is ignored.
+    # allocating it 32-byte aligned keeps every BGRX row (4*W bytes) on an AVX-friendly boundary
+    self._scratch = _alignedEmpty((self._imageHeight, self._imageWidth, 4))
+    np.copyto(self._scratch, cv2.cvtColor(self._backgroundImage, cv2.COLOR_BGR2BGRA))
+
+    # the static punctuation glyphs are baked into the scratch buffer once, and the ROI backup
+    # is taken afterwards so per-frame restores never erase them: the draw loop only ever has
+    # to touch the 20 digit slots (and in the steady state, just the ones that changed)
+    for (x, w, isStatic), ch in zip(self._slots, timeTemplate):
+      if isStatic and w > 0:
+        self._blendGlyphAt(ch, x, w)
+    self._textROIBackup = self._scratch[self._textY0:self._textY1, self._textX0:self._textX1].copy()
+
+    # single-slot encode cache: only the text changes between frames, so when two consecutive
+    # frames render the same string the previous JPEG can be reused without touching the encoder
+    self._lastEncodedStr = None
+    self._lastEncodedJPEG = None
+
+    # formatter cache: the YYYY-MM-DD HH:MM:SS prefix only changes once per second
+    self._lastSecond = -1
+    self._timePrefix = ''
+
+    # per-slot change tracking: the date/hour/minute glyphs stay identical for seconds
+    # (or hours) at a time, so only slots whose character changed get redrawn
+    self._lastDrawnChars = None
+
+  def _formatTimeNow(self):
+    '''formats the current time as YYYY-MM-DD HH:MM:SS.ffffff without going through
+       datetime.strftime (format-string parsing on every call); the date/time prefix is
+       only rebuilt when the second rolls over'''
+    seconds, nanoseconds = divmod(time.time_ns(), 1_000_000_000)
+    if seconds != self._lastSecond:
+      tm = time.localtime(seconds)
+      self._timePrefix = '%04d-%02d-%02d %02d:%02d:%02d.' % (tm.tm_year, tm.tm_mon, tm.tm_mday,
+                                                             tm.tm_hour, tm.tm_min, tm.tm_sec)
+      self._lastSecond = seconds
+    return self._timePrefix + '%06d' % (nanoseconds // 1000)
+
+  def _blendGlyphAt(self, ch, x, w):
+    '''alpha-blends one cached glyph over the scratch buffer at slot position x'''
+    roi = self._scratch[self._textY0:self._textY1, x:x+w]
+    alpha = self._glyphAlphas[ch]
+    roi[:] = ((roi * (255 - alpha) + 255 * alpha) // 255).astype(np.uint8)
+
+  def _drawTimeString(self, timeNowStr):
+    '''blits the pre-rendered glyphs for the current time into the scratch buffer
+       (numpy slice/mask operations only -- no per-frame putText rasterization).
+       Static punctuation is baked into the background at setup, so only digit slots
+       whose character changed since the previous frame are touched: in the steady
+       state that is the microsecond digits and once a second the seconds field'''
+    y0, y1 = self._textY0, self._textY1
+    lastChars = self._lastDrawnChars
+    if lastChars is None:
+      # first frame: restore the whole text band and draw every dynamic slot
+      self._scratch[y0:y1, self._textX0:self._textX1] = self._textROIBackup
+      lastChars = [None] * len(self._slots)
+    for i, ((x, w, isStatic), ch) in enumerate(zip(self._slots, timeNowStr)):
+      if isStatic or w == 0 or ch == lastChars[i]:
+        continue
+      # restores the background strip under this slot, then alpha-blends the new glyph
+      bx = x - self._textX0
+      self._scratch[y0:y1, x:x+w] = self._textROIBackup[:, bx:bx+w]
+      self._blendGlyphAt(ch, x, w)
+    self._lastDrawnChars = list(timeNowStr)
+
+  def _encodeJPEG(self, image):
+    '''encodes a BGRX image to JPEG, preferring the persistent TurboJPEG handle when available'''
+    # 4:2:0 chroma subsampling: white text on a static photo loses nothing visible to it,
+    # and it quarters the chroma data the DCT/quantization/Huffman stages have to chew on
+    # the ifast DCT is an approximation but indistinguishable at streaming qualities
+    if self._tj is not None:
+      return self._tj.encode(image, quality=self._jpegQuality, pixel_format=TJPF_BGRX,
+                             jpeg_subsample=TJSAMP_420, flags=TJFLAG_FASTDCT)
+    return simplejpeg.encode_jpeg(image, self._jpegQuality, 'BGRX', colorsubsampling='420', fastdct=True) # faster alternative to OPENCV: result, encimg = cv2.imencode('.jpg', image, self._jpegParams)
+
   def getEncodedJPEG(self):
     '''returns a buffef with an encoded JPEG'''
-    timeNowStr = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
-    image = cv2.putText(np.copy(self._backgroundImage), timeNowStr, (self._textX, self._textY), cv2.FONT_HERSHEY_SIMPLEX,  
-                     self._fontSize, (255, 255, 255), 2, cv2.LINE_AA)   
-    encimg = simplejpeg.encode_jpeg(image, self._jpegQuality, 'BGR') # faster alternative to OPENCV: result, encimg = cv2.imencode('.jpg', image)             
-    if self._preview:                   
+    timeNowStr = self._formatTimeNow()
+    # same text as the previous frame means the same pixels, so the encoder can be skipped entirely
+    if timeNowStr == self._lastEncodedStr:
+      return self._lastEncodedJPEG
+    # restores only the pixels under the text and stamps the cached glyphs into the scratch buffer
+    self._drawTimeString(timeNowStr)
+    image = self._scratch
+    encodeStart = time.monotonic()
+    encimg = self._encodeJPEG(image)
+    encodeTime = time.monotonic() - encodeStart
+    # smoothed encode time feeding the adaptive quality control in _encoderLoop
+    # (memoized frames are deliberately not sampled -- they don't encode anything)
+    self._encodeEMA = encodeTime if self._encodeEMA is None else 0.9 * self._encodeEMA + 0.1 * encodeTime
+    self._lastEncodedStr = timeNowStr
+    self._lastEncodedJPEG = encimg
+    if self._preview:
+      try:
+        # the copy decouples the preview from the scratch buffer the encoder keeps mutating,
+        # and it only happens when the preview thread is ready for a new snapshot
+        self._previewQueue.put_nowait(image.copy())
+      except queue.Full:
+        pass # preview window is behind; it will catch up with a later frame
+    return encimg
+
+  def _previewLoop(self):
+    '''shows the most recent encoded frame in a window, off the encoding hot path'''
+    while True:
+      image = self._previewQueue.get()
       cv2.imshow('time',image)
       cv2.waitKey(1)
-    return encimg
-  
+
   def FindMaxFrameRate(self):
     self.logger.info(" -> Testing max FPS (preview=%s)" % ("yes" if self._preview else "no"))
     startTime = time.time()
@@ -124,60 +329,198 @@ class JPEGStreamerServer():
       # accept any new connection
       sockt, addr = self.serverSocket.accept()
       self.logger.info("Client connected %s:%d" % addr)
-      self._clients.add((sockt, addr))
-      
-  def sendMessageToClient(self, socket, message):
-    '''sends the entire frame to the client. Returns the number of bytes sent (if less than len(frame) than client disconnected)'''
-    
+      # disabling Nagle removes its ~40ms coalescing delay per frame, and a 4 MB send buffer
+      # lets a whole JPEG enter the kernel in one sendall instead of many short writes
+      sockt.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      sockt.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+      # a stalled client's sendall gives up after a few seconds instead of pinning frame
+      # buffers forever; the writer thread then drops the client
+      sockt.settimeout(5)
+      # every client gets its own writer thread and a short frame queue, so a slow or
+      # broken client can only ever stall itself (never the broadcaster or other clients)
+      client = (sockt, addr, queue.Queue(maxsize=2))
+      with self._clientsLock:
+        self._clients.append(client)
+      writerThread = threading.Thread(target=self._clientWriterLoop, args=client)
+      writerThread.setDaemon(True)
+      writerThread.start()
+
+  def sendMessageToClient(self, socket, framed):
+    '''sends an already framed message (4-byte length header + JPEG in one buffer) to the
+       client with a single sendall. Returns False if the client disconnected'''
     try:
-      # sends message length
-      socket.sendall(len(message).to_bytes(4, "little"))
-      
-      # sends the entire message using send (instead of sendall) to avoid timeout issues
-      totalsent = 0
-      while totalsent < len(message):
-        sent = socket.send(message[totalsent:])
-        if sent == 0:
-            return totalsent
-        totalsent = totalsent + sent
-      return len(message)
-    
-    except ConnectionAbortedError as e:
-      return 0
+      # header and payload live in one buffer, so they leave in a single write
+      # (one TCP segment instead of a tiny header packet followed by the JPEG)
+      socket.sendall(framed)
+      return True
+
     except:
-      return 0
-    
-     
+      return False
+
+  def _clientWriterLoop(self, sockt, addr, clientQueue):
+    '''sends frames to a single client; runs on that client's own daemon thread'''
+    while True:
+      framedview, pendingSends = clientQueue.get()
+      stillConnected = self.sendMessageToClient(sockt, framedview)
+      self._frameDone(framedview, pendingSends)
+      if not stillConnected:
+        break
+    with self._clientsLock:
+      try:
+        self._clients.remove((sockt, addr, clientQueue))
+      except ValueError:
+        pass
+      # releases whatever the broadcaster queued up before the removal, so those
+      # frames' buffers still make it back to the pool
+      while True:
+        try:
+          staleView, stalePending = clientQueue.get_nowait()
+        except queue.Empty:
+          break
+        self._frameDone(staleView, stalePending)
+    self.logger.info("Client disconnected %s:%d" % addr)
+    try:
+      sockt.close()
+    except:
+      pass
+
+  def _frameDone(self, framedview, pendingSends):
+    '''drops one reference to a framed message; the last reference recycles its buffer'''
+    with self._pendingSendsLock:
+      pendingSends[0] = pendingSends[0] - 1
+      lastReference = pendingSends[0] == 0
+    if lastReference:
+      self._releaseFramedBuffer(framedview)
+
+  def _encoderLoop(self):
+    '''encodes frames at the target FPS and publishes the latest framed message into the
+       single-slot swap buffer (stale frames are dropped -- a live clock should never lag)'''
+    # absolute deadline schedule on the monotonic clock: a slow frame doesn't shift the
+    # cadence of the frames after it, and wall-clock (NTP) jumps can't distort the pacing
+    interval = 1.0 / self._fps
+    nextDeadline = time.monotonic() + interval
+    framesSinceQualityCheck = 0
+    while self._streaming:
+      # nobody is watching: don't render or encode frames that go nowhere
+      # (the preview window counts as a watcher, so it keeps updating when enabled)
+      with self._clientsLock:
+        idle = not self._clients
+      if idle and not self._preview:
+        time.sleep(interval)
+        nextDeadline = time.monotonic() + interval # restart the schedule when clients return
+        continue
+
+      jpg = self.getEncodedJPEG() # creates JPEG
+
+      # adaptive quality: encode time is roughly linear in the bytes produced, so when the
+      # smoothed encode time eats most of the frame budget we trade quality for speed, and
+      # when there is plenty of headroom we give the quality back (up to the configured one)
+      framesSinceQualityCheck = framesSinceQualityCheck + 1
+      if framesSinceQualityCheck >= 30 and self._encodeEMA is not None:
+        framesSinceQualityCheck = 0
+        if self._encodeEMA > 0.8 * interval and self._jpegQuality > self._minJPEGQuality:
+          self._jpegQuality = max(self._minJPEGQuality, self._jpegQuality - 5)
+          self.logger.info("Encoding takes %.1fms of the %.1fms budget: lowering quality to %d" % (self._encodeEMA * 1000, interval * 1000, self._jpegQuality))
+        elif self._encodeEMA < 0.5 * interval and self._jpegQuality < self._maxJPEGQuality:
+          self._jpegQuality = min(self._maxJPEGQuality, self._jpegQuality + 5)
+          self.logger.info("Encoding takes %.1fms of the %.1fms budget: raising quality to %d" % (self._encodeEMA * 1000, interval * 1000, self._jpegQuality))
+
+      # frames the message once per frame (not once per client): length header + payload
+      # in one buffer, shared with every client send through memoryviews (no concat copies).
+      # The buffer comes from a small reusable pool instead of a fresh bytearray per frame,
+      # so steady-state streaming allocates nothing; it only grows when a frame is bigger
+      # than any seen before. An empty pool (every buffer pinned at stalled clients) falls
+      # back to allocating a fresh buffer: the extras join the pool once released, so the
+      # encoder is never blocked and healthy clients keep getting frames
+      framedLength = 4 + len(jpg)
+      try:
+        framed = self._bufferPool.get_nowait()
+      except queue.Empty:
+        framed = bytearray(64 * 1024)
+      if len(framed) < framedLength:
+        framed.extend(bytes(framedLength - len(framed)))
+      _lengthHeader.pack_into(framed, 0, len(jpg))
+      framed[4:framedLength] = jpg
+      framedview = memoryview(framed)[:framedLength]
+
+      # single-slot swap: if the broadcaster still holds the previous frame, replace it
+      # (and hand the stale frame's buffer straight back to the pool)
+      try:
+        self._frameQueue.put_nowait(framedview)
+      except queue.Full:
+        try:
+          self._releaseFramedBuffer(self._frameQueue.get_nowait())
+        except queue.Empty:
+          pass
+        try:
+          self._frameQueue.put_nowait(framedview)
+        except queue.Full:
+          self._releaseFramedBuffer(framedview)
+
+      remaingSleepTime = nextDeadline - time.monotonic()
+      if remaingSleepTime > 0:
+        time.sleep(remaingSleepTime)
+      else:
+        self.logger.info("We took too long (%f sec instead of %f sec)" % (interval-remaingSleepTime,interval))
+      nextDeadline = nextDeadline + interval
+      if remaingSleepTime < -interval: # too far behind to catch up: restart the schedule
+        nextDeadline = time.monotonic() + interval
+
+  def _releaseFramedBuffer(self, framedview):
+    '''returns the bytearray behind a framed-message view to the reusable buffer pool'''
+    buffer = framedview.obj
+    framedview.release()
+    self._bufferPool.put(buffer)
+
   def JPEGStreamingLoop(self):
-    loopForever = True
-    maxTimePerFrame = (1.0 / self._fps) - 0.005
-    while loopForever:
+    '''encodes on a background thread and broadcasts on this one, so frame N+1 is being
+       encoded while frame N is still going out to the clients'''
+    self._streaming = True
+    self._frameQueue = queue.Queue(maxsize=1)
+    # reusable send buffers (see _encoderLoop): a stalled client can pin up to three
+    # buffers (one blocked in its sendall plus two in its queue) until the send timeout
+    # evicts it, so this is just a starting set -- when every buffer is pinned the
+    # encoder allocates fresh ones on the fly and they join the pool once released
+    self._bufferPool = queue.Queue()
+    for i in range(4):
+      self._bufferPool.put(bytearray(64 * 1024))
+    self._encoderThread = threading.Thread(target=self._encoderLoop)
+    self._encoderThread.setDaemon(True) # script ends even if this thread is still running
+    self._encoderThread.start()
+
+    while self._streaming:
       try:
-        startTime = time.time()         # check how long it takes to encode and stream frame
-        jpg = self.getEncodedJPEG() # creates JPEG
-        
-        removalSet = set()
-        
-        for client in self._clients:
-          if self.sendMessageToClient(client[0],jpg) < len(jpg):
-            removalSet.add(client)
-            
-        for client in removalSet:
-          self._clients.remove(client)
-          self.logger.info("Client disconnected %s:%d" % client[1])
-          
-        remaingSleepTime = maxTimePerFrame - (time.time() - startTime)
-        if remaingSleepTime > 0:
-          time.sleep(remaingSleepTime)
-        else:
-          self.logger.info("We took too long (%f sec instead of %f sec)" % (maxTimePerFrame-remaingSleepTime,maxTimePerFrame))
-        
+        framedview = self._frameQueue.get() # waits for the encoder to publish the next frame
+
+        # hands the frame to every client's writer thread instead of sending inline, so
+        # the broadcaster never touches a socket and can never be blocked by one.
+        # pendingSends is the frame's reference count; the broadcaster holds a reference
+        # of its own so the buffer goes back to the pool exactly once even when there
+        # are no clients connected at all
+        with self._clientsLock:
+          pendingSends = [len(self._clients) + 1]
+          for client in self._clients:
+            try:
+              client[2].put_nowait((framedview, pendingSends))
+            except queue.Full:
+              # the client is behind: replace its oldest waiting frame with this one
+              try:
+                staleView, stalePending = client[2].get_nowait()
+                self._frameDone(staleView, stalePending)
+              except queue.Empty:
+                pass
+              try:
+                client[2].put_nowait((framedview, pendingSends))
+              except queue.Full:
+                self._frameDone(framedview, pendingSends) # writer raced us: skip this frame for it
+        self._frameDone(framedview, pendingSends)
+
       except KeyboardInterrupt:
         self.logger.info("CTRL+C requested!")
-        loopForever = False
+        self._streaming = False
       #except:
       #  self.logger.error("Unhandled exception!")
-      #  loopForever = False
+      #  self._streaming = False
       
 
 #